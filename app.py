@@ -1,23 +1,76 @@
 import streamlit as st
-import google.generativeai as genai
-from PIL import Image
+from google.generativeai.types import file_types
+from PIL import Image, ImageOps
 import os
 import time
 import streamlit.components.v1 as components
 import random
 import re
+import json
+import hashlib
+import html
+import io
+import threading
+import sqlite3
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import gspread
 import requests
 from google.oauth2.service_account import Credentials
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 import matplotlib.pyplot as plt
 import matplotlib.font_manager as fm
+from matplotlib import mathtext
 import numpy as np
+from gemini_clients import make_client_manager, make_keyed_model
+from solution_store import store_solution_blob, store_solution_record, load_solution_record
+from key_health import classify_key_error, record_key_outcome
+
+# --- 圖片工具 ---
+# JPEG 沒有透明度，透明 PNG 直接 convert("RGB") 會變成全黑；先貼到白底再轉。
+def flatten_to_rgb(image):
+    if image.mode == "P" and "transparency" in image.info:
+        image = image.convert("RGBA")
+    if image.mode in ("RGBA", "LA"):
+        background = Image.new("RGB", image.size, (255, 255, 255))
+        background.paste(image, mask=image.getchannel("A"))
+        return background
+    if image.mode not in ("RGB", "L"):
+        return image.convert("RGB")
+    return image
+
+# --- 靜態資源 (縮圖快取) ---
+# logo 與題目預覽依內容雜湊只縮圖、編碼一次，之後每次 rerun 直接送快取的小檔 bytes；
+# 相同 bytes 在 Streamlit 端是同一個媒體網址，瀏覽器也會沿用快取。
+LOGO_ICON_SIZE = 64
+LOGO_HEADER_SIZE = 256
+PREVIEW_MAX_SIDE = 720
+THUMBNAIL_CACHE_ENTRIES = 64
+
+@st.cache_data(max_entries=THUMBNAIL_CACHE_ENTRIES, show_spinner=False)
+def make_thumbnail(content_key, max_side, _image_bytes):
+    image = flatten_to_rgb(ImageOps.exif_transpose(Image.open(io.BytesIO(_image_bytes))))
+    image.thumbnail((max_side, max_side))
+    buf = io.BytesIO()
+    image.save(buf, format="JPEG", quality=80, optimize=True)
+    return buf.getvalue()
+
+@st.cache_data(show_spinner=False)
+def read_asset_bytes(path, mtime):
+    with open(path, "rb") as f:
+        return f.read()
+
+def get_asset_thumbnail(path, max_side):
+    if not os.path.exists(path):
+        return None
+    mtime = os.path.getmtime(path)
+    return make_thumbnail(f"{path}:{mtime}", max_side, read_asset_bytes(path, mtime))
 
 # --- 頁面設定 ---
 main_logo_path = "logo.jpg"
-if os.path.exists(main_logo_path):
-    page_icon_set = Image.open(main_logo_path)
+logo_icon_bytes = get_asset_thumbnail(main_logo_path, LOGO_ICON_SIZE)
+if logo_icon_bytes:
+    page_icon_set = Image.open(io.BytesIO(logo_icon_bytes))
 else:
     page_icon_set = "🦔"
 assistant_avatar = "🦔"
@@ -88,20 +141,53 @@ def get_google_sheet_client():
         print(f"GCP 連線失敗: {e}")
     return None
 
-def save_to_google_sheets(grade, mode, image_desc, full_response, key_info=""):
+# --- 解答封存區：見 solution_store.py ---
+SHEET_DESC_LIMIT = 100
+
+# --- 分享解答 (?sid= 永久連結)：紀錄只指向解答封存，見 solution_store.py ---
+def publish_solution(grade, mode, blob_ref, use_pro=False):
+    if not blob_ref:
+        return ""
+    try:
+        return store_solution_record(grade, mode, blob_ref, use_pro)
+    except OSError as e:
+        print(f"解答分享紀錄寫入失敗: {e}")
+        return ""
+
+def get_share_url(sid):
+    base_url = ""
+    try:
+        base_url = st.secrets.get("APP_BASE_URL", "")
+    except Exception:
+        pass
+    if not base_url:
+        headers = st.context.headers
+        host = headers.get("X-Forwarded-Host") or headers.get("Host")
+        if host:
+            base_url = f"{headers.get('X-Forwarded-Proto', 'https')}://{host}/"
+    return f"{base_url.rstrip('/')}/?sid={sid}" if base_url else f"?sid={sid}"
+
+# 回傳 (是否寫入 Sheet, 解答參照)；Sheet 寫入失敗時解答仍會封存在本機
+def save_to_google_sheets(grade, mode, image_desc, full_response, key_info="", plot_code=None):
+    try:
+        blob_ref = store_solution_blob(full_response, image_desc, plot_code)
+    except OSError as e:
+        print(f"解答封存失敗: {e}")
+        blob_ref = ""
     try:
         client = get_google_sheet_client()
         if client:
             sheet = client.open("Jutor_Learning_Data").sheet1
             timestamp = (datetime.now() + timedelta(hours=8)).strftime("%Y-%m-%d %H:%M:%S")
-            sheet.insert_row([timestamp, grade, mode, image_desc, full_response, key_info], index=2)
-            return True
+            desc_summary = image_desc[:SHEET_DESC_LIMIT]
+            sheet.insert_row([timestamp, grade, mode, desc_summary, blob_ref, key_info], index=2)
+            return True, blob_ref
     except Exception as e:
-        st.cache_resource.clear()
-        return False
+        get_google_sheet_client.clear()
+    return False, blob_ref
 
 # --- Telegram 回報函式 ---
-def send_telegram_alert(grade, question_desc, ai_response, student_comment, student_name, image_bytes=None):
+def send_telegram_alert(grade, question_desc, ai_response, student_comment, student_name, image_bytes=None, blob_ref=""):
     try:
         if "telegram" in st.secrets:
             token = st.secrets["telegram"]["bot_token"]
@@ -117,13 +203,14 @@ def send_telegram_alert(grade, question_desc, ai_response, student_comment, stud
 
             safe_response = ai_response[:3500]
             if len(ai_response) > 3500:
-                safe_response += "\n...(後續內容過長，請至 Sheet 查看)"
+                safe_response += f"\n...(後續內容過長，完整解答參照：{blob_ref or '請至 Sheet 查看'})"
 
             message = f"""
 🚨 **Jutor 錯誤回報** 🚨
 -----------------------
 📅 時間: {(datetime.now() + timedelta(hours=8)).strftime('%Y-%m-%d %H:%M:%S')}
 🎓 年級: {grade}
+🗂️ 解答參照: {blob_ref or '無'}
 👤 **回報學生:** {student_name}
 🗣️ **學生意見:** {student_comment}
 
@@ -159,7 +246,6 @@ if 'solve_mode' not in st.session_state: st.session_state.solve_mode = "verbal"
 if 'data_saved' not in st.session_state: st.session_state.data_saved = False
 if 'plot_code' not in st.session_state: st.session_state.plot_code = None
 if 'use_pro_model' not in st.session_state: st.session_state.use_pro_model = False
-if 'trigger_rescue' not in st.session_state: st.session_state.trigger_rescue = False
 if 'trigger_retry' not in st.session_state: st.session_state.trigger_retry = False
 if 'used_key_suffix' not in st.session_state: st.session_state.used_key_suffix = ""
 if 'image_desc_cache' not in st.session_state: st.session_state.image_desc_cache = ""
@@ -167,6 +253,14 @@ if 'full_text_cache' not in st.session_state: st.session_state.full_text_cache =
 if 'is_reporting' not in st.session_state: st.session_state.is_reporting = False
 if 'uploaded_file_bytes' not in st.session_state: st.session_state.uploaded_file_bytes = None
 if 'last_question_text' not in st.session_state: st.session_state.last_question_text = ""
+if 'solution_blob_ref' not in st.session_state: st.session_state.solution_blob_ref = ""
+if 'batch_results' not in st.session_state: st.session_state.batch_results = []
+if 'batch_image_hash' not in st.session_state: st.session_state.batch_image_hash = ""
+if 'batch_skipped' not in st.session_state: st.session_state.batch_skipped = []
+if 'session_image' not in st.session_state: st.session_state.session_image = None
+if 'solution_sid' not in st.session_state: st.session_state.solution_sid = ""
+if 'loaded_sid' not in st.session_state: st.session_state.loaded_sid = ""
+if 'solution_grade' not in st.session_state: st.session_state.solution_grade = ""
 
 # --- 函數區 ---
 def trigger_vibration():
@@ -193,6 +287,103 @@ def execute_and_show_plot(code_snippet):
     except Exception as e:
         st.warning(f"圖形繪製失敗: {e}")
 
+# --- 伺服器端公式預先排版 (低階手機模式) ---
+# 把步驟裡的 $$ 公式用 matplotlib mathtext 預先排成 PNG，寫到 Streamlit 的 static/ 目錄，
+# 頁面上只放一個 <img src="app/static/formulas/<hash>.png">：每次 rerun 只多送約百來個 bytes，
+# 圖檔本身由瀏覽器快取，手機端也不必再跑 KaTeX。以公式雜湊做跨 session 的 LRU 快取，
+# 同一條公式全站只排版一次。mathtext 不支援的公式保留 $$ 交給 KaTeX。
+# 需要 .streamlit/config.toml 的 server.enableStaticServing = true。
+MATH_CACHE_SIZE = 2000
+MATH_FONT_SIZE = 14
+MATH_IMAGE_DPI = 200
+MATH_STATIC_DIR = os.path.join("static", "formulas")
+MATH_STATIC_URL = "app/static/formulas"
+MATH_BLOCK = re.compile(r"\$\$(.+?)\$\$", re.DOTALL)
+
+def remove_formula_file(formula_key):
+    try:
+        os.remove(os.path.join(MATH_STATIC_DIR, f"{formula_key}.png"))
+    except OSError:
+        pass
+
+# 索引記 公式雜湊 -> 顯示寬度 (None 表示 mathtext 排不出來)。
+# 重啟或 cache 清掉後從目錄既有的 PNG 依修改時間重建，超過上限的舊檔順手刪掉，目錄不會無限長大
+@st.cache_resource
+def get_math_image_cache():
+    widths = OrderedDict()
+    try:
+        entries = [e for e in os.scandir(MATH_STATIC_DIR) if e.name.endswith(".png")]
+    except OSError:
+        entries = []
+    entries.sort(key=lambda e: e.stat().st_mtime)
+    for entry in entries[:-MATH_CACHE_SIZE]:
+        remove_formula_file(entry.name[:-4])
+    for entry in entries[-MATH_CACHE_SIZE:]:
+        try:
+            with Image.open(entry.path) as img:
+                widths[entry.name[:-4]] = img.size[0] * 100 // MATH_IMAGE_DPI
+        except OSError:
+            remove_formula_file(entry.name[:-4])
+    return {"lock": threading.Lock(), "widths": widths}
+
+def build_formula_markup(expr, formula_key, width):
+    return (
+        f'<div style="text-align:center; overflow-x:auto;">'
+        f'<img alt="{html.escape(expr, quote=True)}" src="{MATH_STATIC_URL}/{formula_key}.png" width="{width}"></div>'
+    )
+
+def render_formula_markup(expr):
+    cache = get_math_image_cache()
+    formula_key = hashlib.sha1(expr.encode("utf-8")).hexdigest()
+    # 鎖只保護索引的查詢與更新；排版與寫檔在鎖外做，不會卡住其他 session
+    with cache["lock"]:
+        if formula_key in cache["widths"]:
+            cache["widths"].move_to_end(formula_key)
+            width = cache["widths"][formula_key]
+            return build_formula_markup(expr, formula_key, width) if width else None
+    try:
+        # mathtext 的字型沒有中文字，含中文的公式交給 KaTeX
+        if re.search(r"[\u4e00-\u9fff]", expr):
+            raise ValueError("CJK in formula")
+        buf = io.BytesIO()
+        mathtext.math_to_image(f"${expr}$", buf, prop=fm.FontProperties(size=MATH_FONT_SIZE), dpi=MATH_IMAGE_DPI, format="png")
+        width = Image.open(io.BytesIO(buf.getvalue())).size[0] * 100 // MATH_IMAGE_DPI
+        path = os.path.join(MATH_STATIC_DIR, f"{formula_key}.png")
+        if not os.path.exists(path):
+            os.makedirs(MATH_STATIC_DIR, exist_ok=True)
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(buf.getvalue())
+            os.replace(tmp_path, path)
+    except Exception:
+        width = None
+    with cache["lock"]:
+        cache["widths"][formula_key] = width
+        cache["widths"].move_to_end(formula_key)
+        while len(cache["widths"]) > MATH_CACHE_SIZE:
+            evicted_key, evicted_width = cache["widths"].popitem(last=False)
+            if evicted_width:
+                remove_formula_file(evicted_key)
+    return build_formula_markup(expr, formula_key, width) if width else None
+
+# 只有自己產生的 <img> 區塊走 unsafe_allow_html，模型寫的文字一律用一般 markdown 顯示
+def render_step_markdown(step_text):
+    if not st.session_state.get("prerender_math", False):
+        st.markdown(step_text)
+        return
+    cursor = 0
+    for match in MATH_BLOCK.finditer(step_text):
+        prose = step_text[cursor:match.start()]
+        if prose.strip():
+            st.markdown(prose)
+        markup = render_formula_markup(" ".join(match.group(1).split()))
+        if markup is None:
+            st.markdown(match.group(0))
+        else:
+            st.markdown(markup, unsafe_allow_html=True)
+        cursor = match.end()
+    if step_text[cursor:].strip():
+        st.markdown(step_text[cursor:])
 
 # =====================================================================
 # 【核心改動 1】clean_output_format — 新策略：完全不碰 LaTeX 內容
@@ -351,8 +542,9 @@ def build_prompt(grade, target, mode):
 
 col1, col2 = st.columns([1, 4])
 with col1:
-    if os.path.exists(main_logo_path):
-        st.image(main_logo_path, use_column_width=True)
+    logo_header_bytes = get_asset_thumbnail(main_logo_path, LOGO_HEADER_SIZE)
+    if logo_header_bytes:
+        st.image(logo_header_bytes, use_column_width=True)
     else:
         st.markdown("<div style='font-size: 3rem; text-align: center;'>🦔</div>", unsafe_allow_html=True)
 
@@ -367,16 +559,128 @@ with col_grade_label:
     st.caption("Jutor 會依此調整講解口吻。")
 with col_grade_select:
     selected_grade = st.selectbox("年級", ("小五", "小六", "國一", "國二", "國三", "高一", "高二", "高三"), label_visibility="collapsed")
+st.toggle("📱 低階手機順暢模式 (公式由伺服器預先排版)", key="prerender_math")
 st.markdown("---")
 
-def call_gemini_with_rotation(prompt_content, image_input=None, use_pro=False):
+def get_api_keys():
     try:
         keys = st.secrets["API_KEYS"]
         if isinstance(keys, str): keys = [keys]
+        return list(keys)
     except:
         st.error("API_KEYS 設定錯誤")
         st.stop()
 
+# --- Gemini client 池 ---
+# 每把 key 一個 client manager、每個 (key, 模型) 一個 GenerativeModel (見 gemini_clients.py)，
+# 跨 session / 執行緒共用，之後完全不呼叫 genai.configure()。
+@st.cache_resource
+def get_gemini_client_pool():
+    return {"lock": threading.RLock(), "managers": {}, "models": {}}
+
+# 背景執行緒不能碰 st.cache_resource：pool 由主執行緒取好傳進來，沒傳才自己拿
+def get_client_manager(api_key, pool=None):
+    pool = pool or get_gemini_client_pool()
+    with pool["lock"]:
+        manager = pool["managers"].get(api_key)
+        if manager is None:
+            manager = make_client_manager(api_key)
+            pool["managers"][api_key] = manager
+        return manager
+
+def get_pooled_model(api_key, model_name, pool=None):
+    pool = pool or get_gemini_client_pool()
+    with pool["lock"]:
+        model = pool["models"].get((api_key, model_name))
+        if model is None:
+            model = make_keyed_model(get_client_manager(api_key, pool), model_name)
+            pool["models"][(api_key, model_name)] = model
+        return model
+
+def get_pooled_file_client(api_key, pool=None):
+    pool = pool or get_gemini_client_pool()
+    with pool["lock"]:
+        return get_client_manager(api_key, pool).get_default_client("file")
+
+# --- 圖片上傳代號 (Upload once, reuse everywhere) ---
+# 每張預處理過的圖片對每把 key 只上傳一次 (Gemini File API)，之後解題、
+# Pro 升級、Q&A、批次解題都只傳檔案參照；快取跨 session 共用並追蹤到期時間。
+# IMAGE_HANDLE_BACKEND = "local" 時改用本機替身 (直接回傳 inline 圖片)，方便離線測試。
+IMAGE_MAX_SIDE = 2048
+IMAGE_HANDLE_TTL = timedelta(hours=47)
+IMAGE_HANDLE_MARGIN = timedelta(minutes=10)
+# 除了到期時間再加筆數上限 (LRU)：local 後端存的是整張 JPEG，不能只靠 47 小時的到期來清
+IMAGE_HANDLE_MAX_ENTRIES = 64
+
+def prepare_session_image(image):
+    image = flatten_to_rgb(ImageOps.exif_transpose(image)).copy()
+    image.thumbnail((IMAGE_MAX_SIDE, IMAGE_MAX_SIDE))
+    buf = io.BytesIO()
+    image.save(buf, format="JPEG", quality=90)
+    data = buf.getvalue()
+    return {"sha256": hashlib.sha256(data).hexdigest(), "part": {"mime_type": "image/jpeg", "data": data}}
+
+def is_session_image(image_input):
+    return isinstance(image_input, dict) and "sha256" in image_input
+
+@st.cache_resource
+def get_image_handle_store():
+    return {"lock": threading.Lock(), "handles": OrderedDict()}
+
+def get_image_handle_backend():
+    try:
+        return st.secrets.get("IMAGE_HANDLE_BACKEND", "gemini")
+    except Exception:
+        return "gemini"
+
+def upload_image_gemini(part, api_key, client_pool=None):
+    file_client = get_pooled_file_client(api_key, client_pool)
+    uploaded = file_types.File(file_client.create_file(io.BytesIO(part["data"]), mime_type=part["mime_type"]))
+    expires_at = getattr(uploaded, "expiration_time", None) or (datetime.now(timezone.utc) + IMAGE_HANDLE_TTL)
+    return uploaded, expires_at
+
+def upload_image_local(part, api_key, client_pool=None):
+    return part, datetime.now(timezone.utc) + IMAGE_HANDLE_TTL
+
+IMAGE_UPLOADERS = {"gemini": upload_image_gemini, "local": upload_image_local}
+
+def resolve_image_handle(session_image, api_key, services=None):
+    services = services or get_solve_services()
+    store = services["handle_store"]
+    cache_key = (session_image["sha256"], api_key)
+    now = datetime.now(timezone.utc)
+    with store["lock"]:
+        for k in [k for k, (_, exp) in store["handles"].items() if exp - IMAGE_HANDLE_MARGIN <= now]:
+            del store["handles"][k]
+        cached = store["handles"].get(cache_key)
+        if cached:
+            store["handles"].move_to_end(cache_key)
+    if cached:
+        return cached[0]
+
+    uploader = IMAGE_UPLOADERS.get(services["image_backend"], upload_image_gemini)
+    handle, expires_at = uploader(session_image["part"], api_key, services["client_pool"])
+    with store["lock"]:
+        store["handles"][cache_key] = (handle, expires_at)
+        store["handles"].move_to_end(cache_key)
+        while len(store["handles"]) > IMAGE_HANDLE_MAX_ENTRIES:
+            store["handles"].popitem(last=False)
+    return handle
+
+def invalidate_image_handle(session_image, api_key, services=None):
+    store = (services or get_solve_services())["handle_store"]
+    with store["lock"]:
+        store["handles"].pop((session_image["sha256"], api_key), None)
+
+# --- Key 健康紀錄 (被動遙測)：見 key_health.py ---
+
+# keys、services 由主執行緒先讀好傳進來，背景執行緒 (批次解題) 就不必碰 st.secrets / st.cache_resource / st.error
+def call_gemini_with_rotation(prompt_content, image_input=None, use_pro=False, keys=None, services=None):
+    if keys is None:
+        keys = get_api_keys()
+    if services is None:
+        services = get_solve_services()
+
     target_keys = keys.copy()
     if use_pro:
         model_name = 'models/gemini-2.5-pro'
@@ -384,15 +688,28 @@ def call_gemini_with_rotation(prompt_content, image_input=None, use_pro=False):
         model_name = 'models/gemini-2.5-flash'
     last_error = None
     for key in target_keys:
+        start_time = time.time()
         try:
-            genai.configure(api_key=key)
-            model = genai.GenerativeModel(model_name)
-            if image_input:
-                response = model.generate_content([prompt_content, image_input])
+            image_part = image_input
+            if is_session_image(image_input):
+                image_part = resolve_image_handle(image_input, key, services)
+            model = get_pooled_model(key, model_name, services["client_pool"])
+            if image_part:
+                try:
+                    response = model.generate_content([prompt_content, image_part])
+                except Exception as e:
+                    # 檔案參照提早失效 (被刪除 / 過期)：丟掉快取重新上傳一次
+                    if not is_session_image(image_input) or ("403" not in str(e) and "404" not in str(e) and "not found" not in str(e).lower()):
+                        raise
+                    invalidate_image_handle(image_input, key, services)
+                    image_part = resolve_image_handle(image_input, key, services)
+                    response = model.generate_content([prompt_content, image_part])
             else:
                 response = model.generate_content(prompt_content)
+            record_key_outcome(key[-4:], "success", time.time() - start_time)
             return response, key[-4:]
         except Exception as e:
+            record_key_outcome(key[-4:], classify_key_error(e))
             if "429" in str(e) or "Quota" in str(e) or "503" in str(e):
                 last_error = e
                 continue
@@ -400,14 +717,460 @@ def call_gemini_with_rotation(prompt_content, image_input=None, use_pro=False):
                 raise e
     raise last_error
 
+# --- 解析模型輸出：DESC / PLOT / STEP ---
+def parse_solution_text(raw_text):
+    full_text = clean_output_format(raw_text)
+    image_desc = "無描述"
+    desc_match = re.search(r"===DESC===(.*?)===DESC_END===", full_text, re.DOTALL)
+    if desc_match:
+        image_desc = desc_match.group(1).strip()
+        full_text = full_text.replace(desc_match.group(0), "")
+    full_text_cache = full_text
+
+    plot_code = None
+    if "===PLOT===" in full_text and "===PLOT_END===" not in full_text:
+        full_text += "\n===PLOT_END==="
+    plot_match = re.search(r"===PLOT===(.*?)===PLOT_END===", full_text, re.DOTALL)
+    if plot_match:
+        plot_code = plot_match.group(1).strip()
+        plot_code = plot_code.replace("```python", "").replace("```", "")
+        full_text = full_text.replace(plot_match.group(0), "")
+
+    steps = [step.strip() for step in full_text.split("===STEP===") if step.strip()]
+    return {
+        "image_desc": image_desc,
+        "full_text": full_text_cache,
+        "solution_text": rebuild_full_text(steps),
+        "plot_code": plot_code,
+        "steps": steps,
+    }
+
+def rebuild_full_text(steps, plot_code=None):
+    full_text = "\n===STEP===\n".join(steps)
+    if plot_code:
+        full_text += f"\n===PLOT===\n{plot_code}\n===PLOT_END==="
+    return full_text
+
+# --- 本機 LaTeX 檢查 + 逐步修復 ---
+# 先在本機檢查每個步驟的 $$ 區塊，只把有問題的步驟平行送去修 (先 flash，不行再 Pro)。
+KATEX_UNSUPPORTED = (
+    "\\documentclass", "\\usepackage", "\\includegraphics", "\\begin{tabular}",
+    "\\multicolumn", "\\multirow", "\\label", "\\eqref", "\\ref{", "\\noindent",
+    "\\centering", "\\par ",
+)
+# $$ 區塊外面出現 \( \) \[ \] 分隔符號，Streamlit 不會渲染 (區塊內的 \\[4pt] 是合法的換行間距)
+STRAY_DELIMITER = re.compile(r"(?<!\\)\\[\[\]()]")
+SPLIT_FORMULA_TAIL = re.compile(r"(=|\+|-|\\times|\\cdot|\\div)$")
+REPAIR_MAX_WORKERS = 4
+
+def validate_step_latex(step):
+    issues = []
+    if step.count("$$") % 2:
+        issues.append("$$ 區塊未成對")
+    matches = list(re.finditer(r"\$\$(.*?)\$\$", step, re.DOTALL))
+    outside_text = re.sub(r"\$\$.*?\$\$", "", step, flags=re.DOTALL)
+    if STRAY_DELIMITER.search(outside_text):
+        issues.append("使用了 \\( \\) 或 \\[ \\] 分隔符號，應改用 $$")
+    for i, match in enumerate(matches):
+        expr = match.group(1).strip()
+        if not expr:
+            issues.append("空白的 $$ 區塊")
+            continue
+        depth = 0
+        for ch in re.sub(r"\\[{}]", "", expr):
+            if ch == "{": depth += 1
+            elif ch == "}": depth -= 1
+            if depth < 0: break
+        if depth != 0:
+            issues.append(f"大括號不平衡：{expr[:40]}")
+        if len(re.findall(r"\\left\b", expr)) != len(re.findall(r"\\right\b", expr)):
+            issues.append(f"\\left / \\right 不成對：{expr[:40]}")
+        for cmd in KATEX_UNSUPPORTED:
+            if cmd in expr:
+                issues.append(f"KaTeX 不支援 {cmd.strip()}")
+        # 只有兩個區塊之間沒有任何文字、且前一個區塊停在運算符號上，才算被拆開的算式
+        if i + 1 < len(matches) and not step[match.end():matches[i + 1].start()].strip() and SPLIT_FORMULA_TAIL.search(expr):
+            issues.append(f"算式被拆成多個 $$ 區塊：{expr[:40]}")
+    return issues
+
+def build_step_repair_prompt(step, issues):
+    issue_lines = "\n".join(f"- {issue}" for issue in issues)
+    return f"""
+【任務：單一步驟 LaTeX 格式修復】
+下方是一段數學教學文本中的「一個步驟」，本機檢查發現以下問題：
+{issue_lines}
+
+【唯一規則：所有數學式一律用 $$ 雙錢號獨立一行包裹，一條算式只用一個 $$ 區塊】
+【嚴禁修改】中文解說內容、數字、計算步驟一律不動，只修格式標記。
+【輸出】只輸出修好的這個步驟，不要加任何說明，不要輸出 ===STEP===。
+
+---待修復步驟---
+{step}
+---結束---
+"""
+
+def repair_single_step(step, issues, keys, services):
+    fixed = step
+    for use_pro in (False, True):
+        try:
+            response, _ = call_gemini_with_rotation(build_step_repair_prompt(step, issues), None, use_pro=use_pro, keys=keys, services=services)
+        except Exception as e:
+            print(f"步驟修復失敗: {e}")
+            continue
+        candidate = clean_output_format(response.text).replace("===STEP===", "").strip()
+        if not candidate:
+            continue
+        fixed = candidate
+        if not validate_step_latex(candidate):
+            break
+    return fixed
+
+def repair_failing_steps(steps, keys, services=None):
+    failing = {i: issues for i, step in enumerate(steps) if (issues := validate_step_latex(step))}
+    if not failing:
+        return steps, 0
+    services = services or get_solve_services()
+    repaired = list(steps)
+    with ThreadPoolExecutor(max_workers=min(REPAIR_MAX_WORKERS, len(failing))) as pool:
+        futures = {pool.submit(repair_single_step, steps[i], issues, keys, services): i for i, issues in failing.items()}
+        for future in as_completed(futures):
+            repaired[futures[future]] = future.result()
+    return repaired, len(failing)
+
+# --- 本機圖片預篩 (NumPy，送模型前先擋掉自拍 / 寵物照) ---
+# 用文字/邊緣密度、色彩飽和度、紙張背景比例、文字行的列投影判斷是不是「像題目」的圖；
+# 文字行最難被照片湊出來，權重算 2，其餘各 1 (滿分 5)，分數不超過 reject_max_score 才拒絕。
+# 門檻可在 secrets 的 [PREFILTER] 覆蓋，
+# 每次判斷與模型最後是否 REFUSE_OFF_TOPIC 都記進 jutor_prefilter.db，供之後調整門檻。
+PREFILTER_SIZE = 256
+PREFILTER_DB = "jutor_prefilter.db"
+DEFAULT_PREFILTER_THRESHOLDS = {
+    "max_saturation": 0.25,
+    "min_paper_ratio": 0.4,
+    "min_line_transitions": 0.04,
+    "min_edge_density": 0.02,
+    "max_edge_density": 0.35,
+    "reject_max_score": 1,
+}
+PREFILTER_WEIGHTS = {"saturation": 1, "paper_ratio": 1, "line_transitions": 2, "edge_density": 1}
+
+def get_prefilter_thresholds():
+    thresholds = dict(DEFAULT_PREFILTER_THRESHOLDS)
+    try:
+        if "PREFILTER" in st.secrets:
+            thresholds.update({k: float(v) for k, v in st.secrets["PREFILTER"].items() if k in thresholds})
+    except Exception:
+        pass
+    return thresholds
+
+def compute_image_features(image):
+    small = flatten_to_rgb(ImageOps.exif_transpose(image))
+    small.thumbnail((PREFILTER_SIZE, PREFILTER_SIZE))
+    rgb = np.asarray(small, dtype=np.float32) / 255.0
+    gray = rgb @ np.array([0.299, 0.587, 0.114], dtype=np.float32)
+    saturation = np.asarray(small.convert("HSV"), dtype=np.float32)[..., 1] / 255.0
+
+    gx = np.abs(np.diff(gray, axis=1)) > 0.15
+    gy = np.abs(np.diff(gray, axis=0)) > 0.15
+    edge_density = (gx.mean() + gy.mean()) / 2
+
+    paper_ratio = ((saturation < 0.15) & (gray > 0.6)).mean()
+
+    # 文字行：墨跡列與空白列交替出現，轉換次數 / 高度 越高越像文件
+    # 用與中位數的絕對差，黑板 / 深色底的淺色字也算墨跡
+    ink = np.abs(gray - np.median(gray)) > 0.2
+    blank_rows = ink.mean(axis=1) < 0.01
+    # 行距至少佔兩列；單獨一列的空白多半是毛皮、草地之類紋理的雜訊，不算
+    padded = np.concatenate([[False], blank_rows, [False]])
+    blank_rows &= padded[:-2] | padded[2:]
+    line_transitions = np.count_nonzero(blank_rows[1:] != blank_rows[:-1]) / len(blank_rows)
+
+    return {
+        "edge_density": round(float(edge_density), 4),
+        "saturation": round(float(saturation.mean()), 4),
+        "paper_ratio": round(float(paper_ratio), 4),
+        "line_transitions": round(float(line_transitions), 4),
+    }
+
+def score_document_likeness(features, thresholds):
+    score = 0
+    if features["saturation"] < thresholds["max_saturation"]: score += PREFILTER_WEIGHTS["saturation"]
+    if features["paper_ratio"] > thresholds["min_paper_ratio"]: score += PREFILTER_WEIGHTS["paper_ratio"]
+    if features["line_transitions"] >= thresholds["min_line_transitions"]: score += PREFILTER_WEIGHTS["line_transitions"]
+    if thresholds["min_edge_density"] < features["edge_density"] < thresholds["max_edge_density"]: score += PREFILTER_WEIGHTS["edge_density"]
+    return score
+
+def run_image_prefilter(image):
+    thresholds = get_prefilter_thresholds()
+    features = compute_image_features(image)
+    score = score_document_likeness(features, thresholds)
+    return {"features": features, "score": score, "rejected": score <= thresholds["reject_max_score"]}
+
+def log_prefilter_event(image_hash, prefilter, overridden=False, model_refused=None):
+    try:
+        conn = sqlite3.connect(PREFILTER_DB, timeout=5)
+    except sqlite3.Error as e:
+        print(f"預篩紀錄開啟失敗: {e}")
+        return
+    try:
+        with conn:
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS prefilter_log (
+                    created_at REAL,
+                    image_hash TEXT,
+                    features TEXT,
+                    score INTEGER,
+                    rejected INTEGER,
+                    overridden INTEGER,
+                    model_refused INTEGER
+                )"""
+            )
+            conn.execute(
+                "INSERT INTO prefilter_log VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    time.time(), image_hash, json.dumps(prefilter["features"]), prefilter["score"],
+                    int(prefilter["rejected"]), int(overridden), None if model_refused is None else int(model_refused),
+                ),
+            )
+    except sqlite3.Error as e:
+        print(f"預篩紀錄寫入失敗: {e}")
+    finally:
+        conn.close()
+
+# --- 模型路由 (自動升級，取代手動 Pro 救援) ---
+# 先用便宜的訊號 (年級、題目長度、DESC 複雜度、該年級 flash 的歷史失敗率) 決定要不要直接用 Pro；
+# flash 的輸出若結構不合格 (沒有 ===STEP===、沒有答案) 且延遲預算還夠，就在同一次等待中自動升級 Pro。
+HARD_GRADES = ("高二", "高三")
+ROUTE_PRO_SCORE = 2
+ROUTE_LONG_TARGET = 40
+ROUTE_COMPLEX_DESC = 300
+ROUTE_FAILURE_RATE = 0.3
+ROUTE_MIN_SAMPLES = 10
+ROUTE_WINDOW = 50
+ROUTE_EXPLORE_RATE = 0.1
+ROUTE_LATENCY_BUDGET = 90
+PRO_EXPECTED_SECONDS = 40
+
+@st.cache_resource
+def get_route_stats():
+    return {"lock": threading.Lock(), "grades": {}}
+
+def record_route_outcome(grade, failed, stats=None):
+    stats = stats or get_route_stats()
+    with stats["lock"]:
+        attempts, failures = stats["grades"].get(grade, (0, 0))
+        attempts, failures = attempts + 1, failures + int(failed)
+        # 只看最近約 ROUTE_WINDOW 次，舊的失敗會逐漸淡出
+        if attempts > ROUTE_WINDOW:
+            failures = failures * ROUTE_WINDOW / attempts
+            attempts = ROUTE_WINDOW
+        stats["grades"][grade] = (attempts, failures)
+
+def flash_failure_rate(grade, stats=None):
+    stats = stats or get_route_stats()
+    with stats["lock"]:
+        attempts, failures = stats["grades"].get(grade, (0, 0))
+    if attempts < ROUTE_MIN_SAMPLES:
+        return 0.0
+    return failures / attempts
+
+def get_route_latency_budget():
+    try:
+        return float(st.secrets.get("ROUTE_LATENCY_BUDGET", ROUTE_LATENCY_BUDGET))
+    except Exception:
+        return float(ROUTE_LATENCY_BUDGET)
+
+def choose_pro_model(grade, target, image_desc="", stats=None):
+    score = 0
+    if grade in HARD_GRADES: score += 1
+    if len(target) > ROUTE_LONG_TARGET: score += 1
+    if len(image_desc) > ROUTE_COMPLEX_DESC or image_desc.count("$$") >= 6: score += 1
+    if flash_failure_rate(grade, stats) >= ROUTE_FAILURE_RATE: score += 1
+    return score >= ROUTE_PRO_SCORE
+
+def check_solution_structure(parsed):
+    issues = []
+    steps = parsed["steps"]
+    if len(steps) < 3:
+        issues.append("缺少 ===STEP=== 分段")
+    answer_step = next((step for step in steps if "本題答案" in step), None)
+    if answer_step is None:
+        issues.append("缺少本題答案")
+    elif not re.sub(r"[#\s💡:：]", "", answer_step.split("本題答案", 1)[1]):
+        issues.append("本題答案是空的")
+    return issues
+
+def solve_with_routing(prompt, session_image, grade, target, keys, image_desc="", services=None):
+    if services is None:
+        services = get_solve_services()
+    use_pro = choose_pro_model(grade, target, image_desc, services["route_stats"])
+    # 保留一小部分流量繼續試 flash，否則失敗率一旦超標就永遠不會再更新
+    if use_pro and random.random() < ROUTE_EXPLORE_RATE:
+        use_pro = False
+    start_time = time.time()
+    response, key_suffix = call_gemini_with_rotation(prompt, session_image, use_pro=use_pro, keys=keys, services=services)
+    if "REFUSE_OFF_TOPIC" in response.text:
+        return {"refused": True, "key_suffix": key_suffix, "use_pro": use_pro, "parsed": None}
+
+    parsed = parse_solution_text(response.text)
+    if not use_pro:
+        issues = check_solution_structure(parsed)
+        record_route_outcome(grade, bool(issues), services["route_stats"])
+        if issues and time.time() - start_time + PRO_EXPECTED_SECONDS <= services["latency_budget"]:
+            try:
+                pro_response, pro_key_suffix = call_gemini_with_rotation(prompt, session_image, use_pro=True, keys=keys, services=services)
+                pro_parsed = parse_solution_text(pro_response.text)
+                if "REFUSE_OFF_TOPIC" not in pro_response.text and len(check_solution_structure(pro_parsed)) <= len(issues):
+                    parsed, key_suffix, use_pro = pro_parsed, pro_key_suffix, True
+            except Exception as e:
+                print(f"自動升級 Pro 失敗，沿用 flash 結果: {e}")
+
+    parsed["steps"], repaired_count = repair_failing_steps(parsed["steps"], keys, services)
+    if repaired_count:
+        parsed["full_text"] = rebuild_full_text(parsed["steps"], parsed["plot_code"])
+        parsed["solution_text"] = rebuild_full_text(parsed["steps"])
+    return {"refused": False, "key_suffix": key_suffix, "use_pro": use_pro, "parsed": parsed}
+
+# --- 整張考卷批次解題 ---
+# 圖片只編碼一次，多題平行送出 (一題一個執行緒)，總等待時間約等於最慢的那一題。
+BATCH_MAX_QUESTIONS = 8
+
+def split_question_targets(text):
+    targets = [t.strip() for t in re.split(r"[,，、;；\n]+", text) if t.strip()]
+    return list(dict.fromkeys(targets))
+
+# 背景執行緒要用的共用資源都在主執行緒先取好 (st.cache_resource / st.secrets 只在這裡碰)
+def get_solve_services():
+    return {
+        "client_pool": get_gemini_client_pool(),
+        "handle_store": get_image_handle_store(),
+        "route_stats": get_route_stats(),
+        "image_backend": get_image_handle_backend(),
+        "latency_budget": get_route_latency_budget(),
+    }
+
+def solve_single_question(grade, target, mode, session_image, keys, services, image_desc=""):
+    prompt = build_prompt(grade, target, mode)
+    try:
+        routed = solve_with_routing(prompt, session_image, grade, target, keys, image_desc, services)
+        if routed["refused"]:
+            return {"target": target, "error": "🙅‍♂️ 這個學校好像不會考喔！", "refused": True}
+        result = routed["parsed"]
+        result.update({"target": target, "mode": mode, "grade": grade, "key_suffix": routed["key_suffix"], "use_pro": routed["use_pro"], "error": None})
+        return result
+    except Exception as e:
+        if "429" in str(e) or "Quota" in str(e):
+            return {"target": target, "error": "🥵 系統忙碌中，請稍候重試！"}
+        return {"target": target, "error": f"錯誤：{e}"}
+
+def render_batch_result(result):
+    if result["error"]:
+        st.error(result["error"])
+        return
+    if result["plot_code"]:
+        with st.expander("📊 查看幾何/函數圖形", expanded=False):
+            execute_and_show_plot(result["plot_code"])
+    for step in result["steps"]:
+        with st.chat_message("assistant", avatar=assistant_avatar):
+            render_step_markdown(step)
+
+def load_result_into_steps(result):
+    st.session_state.solve_mode = result["mode"]
+    st.session_state.solution_grade = result["grade"]
+    st.session_state.use_pro_model = result.get("use_pro", False)
+    st.session_state.used_key_suffix = result["key_suffix"]
+    st.session_state.image_desc_cache = result["image_desc"]
+    st.session_state.full_text_cache = result["full_text"]
+    st.session_state.plot_code = result["plot_code"]
+    st.session_state.solution_steps = result["steps"]
+    st.session_state.last_question_text = result["target"]
+    st.session_state.solution_blob_ref = result.get("blob_ref", "")
+    st.session_state.solution_sid = result.get("sid", "")
+    st.session_state.step_index = 0
+    st.session_state.is_solving = True
+    st.session_state.streaming_done = False
+    st.session_state.in_qa_mode = False
+    st.session_state.qa_history = []
+    st.session_state.data_saved = True
+    st.session_state.is_reporting = False
+
+def run_batch_solve(grade, targets, mode, session_image):
+    keys = get_api_keys()
+    known_desc = session_image.get("image_desc", "")
+    services = get_solve_services()
+    try:
+        # 先在主執行緒上傳一次，各題共用同一個檔案參照
+        resolve_image_handle(session_image, keys[0], services)
+    except Exception as e:
+        print(f"圖片預先上傳失敗: {e}")
+    tabs = st.tabs([f"📝 {t}" for t in targets])
+    slots = {t: tab.empty() for t, tab in zip(targets, tabs)}
+    for t in targets:
+        slots[t].info("⏳ Jutor 正在解這題...")
+
+    results = {}
+    with ThreadPoolExecutor(max_workers=len(targets)) as pool:
+        futures = [pool.submit(solve_single_question, grade, t, mode, session_image, keys, services, known_desc) for t in targets]
+        for future in as_completed(futures):
+            result = future.result()
+            if not result["error"]:
+                _, result["blob_ref"] = save_to_google_sheets(grade, mode, result["image_desc"], result["solution_text"], result["key_suffix"], result["plot_code"])
+                result["sid"] = publish_solution(grade, mode, result["blob_ref"], result["use_pro"])
+            results[result["target"]] = result
+            with slots[result["target"]].container():
+                render_batch_result(result)
+    first_desc = next((results[t]["image_desc"] for t in targets if not results[t]["error"]), "")
+    if first_desc and not known_desc:
+        session_image["image_desc"] = first_desc
+    return [results[t] for t in targets]
+
+# --- 開啟分享連結：直接載入已存好的解答，不呼叫模型 ---
+shared_sid = st.query_params.get("sid")
+if shared_sid and shared_sid != st.session_state.loaded_sid:
+    st.session_state.loaded_sid = shared_sid
+    shared_record = load_solution_record(shared_sid)
+    if shared_record:
+        load_result_into_steps({
+            "mode": shared_record["mode"],
+            "key_suffix": "",
+            "image_desc": shared_record["image_desc"],
+            "full_text": rebuild_full_text(shared_record["steps"], shared_record["plot_code"]),
+            "plot_code": shared_record["plot_code"],
+            "steps": shared_record["steps"],
+            "target": "",
+            "grade": shared_record["grade"],
+            "blob_ref": shared_record["blob_ref"],
+            "sid": shared_sid,
+        })
+        st.session_state.use_pro_model = shared_record["use_pro"]
+        st.session_state.session_image = None
+        st.session_state.uploaded_file_bytes = None
+    else:
+        st.warning("⚠️ 找不到這份分享的解答，可能連結有誤。")
+
 if not st.session_state.is_solving:
     st.subheader("📸 1️⃣ 上傳題目 & 指定")
     uploaded_file = st.file_uploader("選擇圖片 (JPG, PNG)", type=["jpg", "png", "jpeg"], label_visibility="collapsed")
 
     if uploaded_file is not None:
         image = Image.open(uploaded_file)
-        st.image(image, caption='題目預覽', use_column_width=True)
-        question_target = st.text_input("你想問圖片中的哪一題？", placeholder="例如：第 5 題...")
+        image_hash = hashlib.sha256(uploaded_file.getvalue()).hexdigest()
+        st.image(make_thumbnail(image_hash, PREVIEW_MAX_SIDE, uploaded_file.getvalue()), caption='題目預覽', use_column_width=True)
+        if st.session_state.session_image is None or st.session_state.session_image.get("source_hash") != image_hash:
+            st.session_state.session_image = prepare_session_image(image)
+            st.session_state.session_image["source_hash"] = image_hash
+        if "prefilter" not in st.session_state.session_image:
+            st.session_state.session_image["prefilter"] = run_image_prefilter(image)
+        prefilter = st.session_state.session_image["prefilter"]
+        prefilter_override = False
+        if prefilter["rejected"]:
+            st.warning("🤔 這張圖看起來不太像數學題目耶...")
+            prefilter_override = st.checkbox("我確定這是題目，仍然要解題", value=False)
+        batch_mode = st.toggle("📚 整張考卷模式：一次問多題", value=False)
+        if batch_mode:
+            question_target = st.text_input("你想問圖片中的哪幾題？(用逗號分隔)", placeholder="例如：1, 3, 5")
+        else:
+            question_target = st.text_input("你想問圖片中的哪一題？", placeholder="例如：第 5 題...")
 
         st.markdown("### 🚀 選擇解題模式：")
 
@@ -420,33 +1183,57 @@ if not st.session_state.is_solving:
         with col_btn_toxic:
             start_toxic = st.button("☠️ 毒舌模式", use_container_width=True)
 
-        if start_verbal or start_math or start_toxic or st.session_state.trigger_rescue:
+        if prefilter["rejected"] and not prefilter_override and (start_verbal or start_math or start_toxic):
+            st.error("🙅‍♂️ 這個學校好像不會考喔！(若為誤判，請勾選上方的確認選項)")
+            log_prefilter_event(image_hash, prefilter)
+            start_verbal = start_math = start_toxic = False
+
+        if batch_mode and (start_verbal or start_math or start_toxic):
+            targets = split_question_targets(question_target)
+            if not targets:
+                st.warning("⚠️ 請先輸入你想問哪幾題！")
+            else:
+                st.session_state.batch_skipped = targets[BATCH_MAX_QUESTIONS:]
+                targets = targets[:BATCH_MAX_QUESTIONS]
+                if start_toxic: mode = "toxic"
+                elif start_math: mode = "math"
+                else: mode = "verbal"
+                st.session_state.uploaded_file_bytes = uploaded_file.getvalue()
+                st.session_state.batch_results = run_batch_solve(selected_grade, targets, mode, st.session_state.session_image)
+                answered = [r for r in st.session_state.batch_results if r.get("refused") or not r["error"]]
+                if answered:
+                    log_prefilter_event(image_hash, prefilter, prefilter_override, any(r.get("refused") for r in answered))
+                st.session_state.batch_image_hash = image_hash
+                st.rerun()
+
+        elif st.session_state.batch_results and st.session_state.batch_image_hash == image_hash:
+            if st.session_state.batch_skipped:
+                st.warning(f"⚠️ 一次最多解 {BATCH_MAX_QUESTIONS} 題，{'、'.join(st.session_state.batch_skipped)} 這次沒有解，請再送一次！")
+            tab_targets = [r["target"] for r in st.session_state.batch_results]
+            for tab, result in zip(st.tabs([f"📝 {t}" for t in tab_targets]), st.session_state.batch_results):
+                with tab:
+                    if not result["error"]:
+                        if st.button("🎯 逐步講解這題", key=f"batch_step_{result['target']}", use_container_width=True, type="primary"):
+                            st.session_state.uploaded_file_bytes = uploaded_file.getvalue()
+                            load_result_into_steps(result)
+                            st.rerun()
+                    render_batch_result(result)
+
+        if not batch_mode and (start_verbal or start_math or start_toxic):
             if not question_target:
                 st.warning("⚠️ 請先輸入你想問哪一題！")
             else:
                 st.session_state.last_question_text = question_target
 
-                if st.session_state.trigger_rescue:
-                    mode = st.session_state.solve_mode
-                    use_pro = True
-                    st.session_state.use_pro_model = True
-                    st.session_state.trigger_rescue = False
-                else:
-                    if start_toxic: mode = "toxic"
-                    elif start_math: mode = "math"
-                    else: mode = "verbal"
-
-                    st.session_state.solve_mode = mode
-                    use_pro = False
-                    st.session_state.use_pro_model = False
+                if start_toxic: mode = "toxic"
+                elif start_math: mode = "math"
+                else: mode = "verbal"
+                st.session_state.solve_mode = mode
 
-                if use_pro:
-                    loading_text = "Jutor Pro (2.5) 正在深度分析並修復錯誤..."
+                if mode == "toxic":
+                    loading_text = "Jutor AI (2.5) 正在深呼吸準備開罵..."
                 else:
-                    if mode == "toxic":
-                        loading_text = "Jutor AI (2.5) 正在深呼吸準備開罵..."
-                    else:
-                        loading_text = "Jutor AI (2.5) 正在思考怎麼教會你這題..."
+                    loading_text = "Jutor AI (2.5) 正在思考怎麼教會你這題..."
 
                 with st.spinner(loading_text):
                     try:
@@ -454,35 +1241,27 @@ if not st.session_state.is_solving:
                             st.session_state.uploaded_file_bytes = uploaded_file.getvalue()
 
                         prompt = build_prompt(selected_grade, question_target, mode)
-                        response, key_suffix = call_gemini_with_rotation(prompt, image, use_pro=use_pro)
+                        known_desc = st.session_state.session_image.get("image_desc", "")
+                        routed = solve_with_routing(prompt, st.session_state.session_image, selected_grade, question_target, get_api_keys(), known_desc)
+                        key_suffix = routed["key_suffix"]
+                        use_pro = routed["use_pro"]
                         st.session_state.used_key_suffix = key_suffix
+                        st.session_state.use_pro_model = use_pro
+                        log_prefilter_event(image_hash, prefilter, prefilter_override, routed["refused"])
 
-                        if "REFUSE_OFF_TOPIC" in response.text:
+                        if routed["refused"]:
                             st.error("🙅‍♂️ 這個學校好像不會考喔！(若為誤判，請嘗試裁切圖片)")
                         else:
-                            full_text = clean_output_format(response.text)
-                            image_desc = "無描述"
-                            desc_match = re.search(r"===DESC===(.*?)===DESC_END===", full_text, re.DOTALL)
-                            if desc_match:
-                                image_desc = desc_match.group(1).strip()
-                                full_text = full_text.replace(desc_match.group(0), "")
+                            parsed = routed["parsed"]
+                            st.session_state.session_image["image_desc"] = parsed["image_desc"]
+                            image_desc = parsed["image_desc"]
+                            full_text = parsed["solution_text"]
+                            plot_code = parsed["plot_code"]
 
                             st.session_state.image_desc_cache = image_desc
-                            st.session_state.full_text_cache = full_text
-
-                            plot_code = None
-                            if "===PLOT===" in full_text and "===PLOT_END===" not in full_text:
-                                full_text += "\n===PLOT_END==="
-                            plot_match = re.search(r"===PLOT===(.*?)===PLOT_END===", full_text, re.DOTALL)
-                            if plot_match:
-                                plot_code = plot_match.group(1).strip()
-                                plot_code = plot_code.replace("```python", "").replace("```", "")
-                                full_text = full_text.replace(plot_match.group(0), "")
-
+                            st.session_state.full_text_cache = parsed["full_text"]
                             st.session_state.plot_code = plot_code
-
-                            raw_steps = full_text.split("===STEP===")
-                            st.session_state.solution_steps = [step.strip() for step in raw_steps if step.strip()]
+                            st.session_state.solution_steps = parsed["steps"]
                             st.session_state.step_index = 0
                             st.session_state.is_solving = True
                             st.session_state.streaming_done = False
@@ -491,7 +1270,9 @@ if not st.session_state.is_solving:
                             st.session_state.data_saved = False
                             st.session_state.is_reporting = False
 
-                            save_to_google_sheets(selected_grade, mode, image_desc, full_text, key_suffix)
+                            _, st.session_state.solution_blob_ref = save_to_google_sheets(selected_grade, mode, image_desc, full_text, key_suffix, plot_code)
+                            st.session_state.solution_grade = selected_grade
+                            st.session_state.solution_sid = publish_solution(selected_grade, mode, st.session_state.solution_blob_ref, use_pro)
                             st.rerun()
 
                     except Exception as e:
@@ -515,7 +1296,7 @@ if st.session_state.is_solving and st.session_state.solution_steps:
         header_text = "Jutor 解題中"
 
     if st.session_state.use_pro_model:
-        st.markdown(f"### {header_text} (🔥 2.5 Pro 救援)")
+        st.markdown(f"### {header_text} (🔥 2.5 Pro 深度解析)")
     else:
         st.markdown(f"### {header_text}")
 
@@ -528,12 +1309,12 @@ if st.session_state.is_solving and st.session_state.solution_steps:
 
     for i in range(st.session_state.step_index):
         with st.chat_message("assistant", avatar=assistant_avatar):
-            st.markdown(st.session_state.solution_steps[i])
+            render_step_markdown(st.session_state.solution_steps[i])
 
     current_step_text = st.session_state.solution_steps[st.session_state.step_index]
     with st.chat_message("assistant", avatar=assistant_avatar):
         trigger_vibration()
-        st.markdown(current_step_text)
+        render_step_markdown(current_step_text)
 
     total_steps = len(st.session_state.solution_steps)
 
@@ -556,12 +1337,13 @@ if st.session_state.is_solving and st.session_state.solution_steps:
                         st.warning("請填寫名字和問題描述喔！")
                     else:
                         success = send_telegram_alert(
-                            selected_grade,
+                            st.session_state.solution_grade or selected_grade,
                             st.session_state.image_desc_cache,
                             st.session_state.full_text_cache,
                             student_comment,
                             student_name,
-                            st.session_state.uploaded_file_bytes
+                            st.session_state.uploaded_file_bytes,
+                            st.session_state.solution_blob_ref
                         )
                         if success:
                             st.session_state.is_reporting = False
@@ -621,7 +1403,7 @@ if st.session_state.is_solving and st.session_state.solution_steps:
                         with st.spinner("思考中..."):
                             try:
                                 full_prompt = "對話紀錄:\n" + "\n".join([f"{h['role']}:{h['parts'][0]}" for h in st.session_state.qa_history]) + f"\n新問題:{user_question}"
-                                response, _ = call_gemini_with_rotation(full_prompt, use_pro=st.session_state.use_pro_model)
+                                response, _ = call_gemini_with_rotation(full_prompt, st.session_state.session_image, use_pro=st.session_state.use_pro_model)
                                 st.markdown(response.text)
                                 st.session_state.qa_history.append({"role": "model", "parts": [response.text]})
                             except:
@@ -653,6 +1435,8 @@ if st.session_state.is_solving and st.session_state.solution_steps:
                 st.session_state.use_pro_model = False
                 st.session_state.is_reporting = False
                 st.session_state.uploaded_file_bytes = None
+                st.session_state.solution_sid = ""
+                st.query_params.clear()
                 st.rerun()
 
     # --- 底部工具列 ---
@@ -664,14 +1448,23 @@ if st.session_state.is_solving and st.session_state.solution_steps:
 
         with col_util_1:
             if st.button("🔧 內容沒錯但亂碼？點我修復", use_container_width=True):
-                st.toast("🚑 正在請求主任醫師 (Pro) 進行微創手術...", icon="👨‍⚕️")
-
                 try:
+                    steps = st.session_state.solution_steps
                     bad_text = st.session_state.full_text_cache
 
-                    if not bad_text:
+                    if not steps or not bad_text:
                         st.warning("⚠️ 目前沒有內容可以修復喔！")
+                    elif any(validate_step_latex(step) for step in steps):
+                        st.toast("🩹 只修有問題的步驟，馬上好...", icon="👨‍⚕️")
+                        with st.spinner("🔧 Jutor 正在修復出問題的步驟..."):
+                            fixed_steps, _ = repair_failing_steps(steps, get_api_keys())
+                            st.session_state.solution_steps = fixed_steps
+                            st.session_state.full_text_cache = rebuild_full_text(fixed_steps, st.session_state.plot_code)
+                            st.session_state.solution_sid = ""
+                            st.rerun()
                     else:
+                        # 本機檢查不出問題，但學生看到亂碼：退回整份交給 Pro 重新排版
+                        st.toast("🚑 正在請求主任醫師 (Pro) 進行微創手術...", icon="👨‍⚕️")
                         repair_prompt = f"""
 【任務：Streamlit LaTeX 格式修復】
 你是 Streamlit 介面優化專家。請修復下方數學教學文本的格式，讓它能在 Streamlit 中正確渲染。
@@ -700,6 +1493,7 @@ $$\cos C = \frac{{1}}{{2\sqrt{{7}}}}$$
                             fixed_text = clean_output_format(response.text)
 
                             st.session_state.full_text_cache = fixed_text
+                            st.session_state.solution_sid = ""
 
                             plot_code = None
                             if "===PLOT===" in fixed_text and "===PLOT_END===" not in fixed_text:
@@ -728,3 +1522,27 @@ $$\cos C = \frac{{1}}{{2\sqrt{{7}}}}$$
             if st.button("🚨 答案有錯，回報給鳩特", use_container_width=True, type="secondary"):
                 st.session_state.is_reporting = True
                 st.rerun()
+
+        with st.expander("🔗 分享這份解答給全班"):
+            if st.button("產生分享連結", use_container_width=True):
+                # 封存以內容定址：未修改的解答會對到解題時已存的同一份，修復過的步驟才會另存新的
+                try:
+                    st.session_state.solution_blob_ref = store_solution_blob(
+                        rebuild_full_text(st.session_state.solution_steps),
+                        st.session_state.image_desc_cache,
+                        st.session_state.plot_code,
+                    )
+                except OSError as e:
+                    print(f"解答封存失敗: {e}")
+                st.session_state.solution_sid = publish_solution(
+                    st.session_state.solution_grade or selected_grade,
+                    st.session_state.solve_mode,
+                    st.session_state.solution_blob_ref,
+                    st.session_state.use_pro_model,
+                )
+                if st.session_state.solution_sid:
+                    st.session_state.loaded_sid = st.session_state.solution_sid
+                    st.query_params["sid"] = st.session_state.solution_sid
+            if st.session_state.solution_sid:
+                st.caption("複製下面的連結給同學即可：")
+                st.code(get_share_url(st.session_state.solution_sid), language=None)
@@ -0,0 +1,17 @@
+import google.generativeai as genai
+# ⚠️ 以下用到 google-generativeai 的私有 API (_ClientManager、GenerativeModel._client)，
+# 官方沒有「每把 key 一個 client」的公開寫法；requirements.txt 已將版本鎖在 <0.9，升級前請重新確認。
+from google.generativeai.client import _ClientManager
+
+# --- 每把 key 獨立的 Gemini client ---
+# genai.configure() 是整個 process 共用的設定，多個 session 同時切換 key 會互相打架；
+# 這裡的物件只綁定自己的 key，可以跨執行緒共用，底層 gRPC 連線也會重複使用。
+def make_client_manager(api_key):
+    manager = _ClientManager()
+    manager.configure(api_key=api_key)
+    return manager
+
+def make_keyed_model(manager, model_name):
+    model = genai.GenerativeModel(model_name)
+    model._client = manager.get_default_client("generative")
+    return model
@@ -0,0 +1,87 @@
+import sqlite3
+import threading
+import time
+
+# --- Key 健康紀錄 (被動遙測) ---
+# 每次真實呼叫的結果 (成功 / 429 / 503 / 無效 / 其他錯誤、延遲、最後出現時間) 寫進本機 SQLite。
+# app.py 的真實流量與 monitor.py 的主動探測都透過 record_key_outcome 寫進同一份紀錄，
+# monitor.py 直接讀這份紀錄顯示每把 key 的健康狀態。
+KEY_HEALTH_DB = "jutor_key_health.db"
+KEY_COOLDOWN_SECONDS = 60
+KEY_OUTCOME_COLUMNS = {
+    "success": "success_count",
+    "rate_limited": "rate_limited_count",
+    "unavailable": "unavailable_count",
+    "invalid": "invalid_count",
+    "error": "error_count",
+}
+
+# WAL 與建表只在 process 第一次寫入時做；寫入失敗就重設，下次再建一次 (例如 db 檔被刪掉)
+_schema_lock = threading.Lock()
+_schema_ready = False
+
+def classify_key_error(e):
+    error_msg = str(e)
+    if "429" in error_msg or "Quota" in error_msg:
+        return "rate_limited"
+    if "503" in error_msg:
+        return "unavailable"
+    if "API key not valid" in error_msg:
+        return "invalid"
+    return "error"
+
+def ensure_key_health_schema(conn):
+    global _schema_ready
+    with _schema_lock:
+        if _schema_ready:
+            return
+        conn.execute("PRAGMA journal_mode=WAL")
+        with conn:
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS key_health (
+                    key_suffix TEXT PRIMARY KEY,
+                    success_count INTEGER DEFAULT 0,
+                    rate_limited_count INTEGER DEFAULT 0,
+                    unavailable_count INTEGER DEFAULT 0,
+                    invalid_count INTEGER DEFAULT 0,
+                    error_count INTEGER DEFAULT 0,
+                    latency_total REAL DEFAULT 0,
+                    last_outcome TEXT,
+                    last_seen REAL,
+                    cooldown_until REAL DEFAULT 0
+                )"""
+            )
+        _schema_ready = True
+
+def record_key_outcome(key_suffix, outcome, latency=0.0):
+    global _schema_ready
+    column = KEY_OUTCOME_COLUMNS[outcome]
+    now = time.time()
+    cooldown_until = now + KEY_COOLDOWN_SECONDS if outcome == "rate_limited" else 0.0
+    try:
+        conn = sqlite3.connect(KEY_HEALTH_DB, timeout=5)
+    except sqlite3.Error as e:
+        print(f"Key 健康紀錄開啟失敗: {e}")
+        return
+    try:
+        ensure_key_health_schema(conn)
+        # 成功就代表額度已恢復，冷卻直接歸零；其他結果保留較晚的冷卻時間
+        with conn:
+            conn.execute(
+                f"""INSERT INTO key_health (key_suffix, {column}, latency_total, last_outcome, last_seen, cooldown_until)
+                    VALUES (?, 1, ?, ?, ?, ?)
+                    ON CONFLICT(key_suffix) DO UPDATE SET
+                        {column} = {column} + 1,
+                        latency_total = latency_total + excluded.latency_total,
+                        last_outcome = excluded.last_outcome,
+                        last_seen = excluded.last_seen,
+                        cooldown_until = CASE WHEN excluded.last_outcome = 'success' THEN 0
+                                              ELSE MAX(cooldown_until, excluded.cooldown_until) END""",
+                (key_suffix, latency if outcome == "success" else 0.0, outcome, now, cooldown_until),
+            )
+    except sqlite3.Error as e:
+        print(f"Key 健康紀錄寫入失敗: {e}")
+        with _schema_lock:
+            _schema_ready = False
+    finally:
+        conn.close()
@@ -1,5 +1,4 @@
 import streamlit as st
-import google.generativeai as genai
 import time
 import gspread
 from google.oauth2.service_account import Credentials
@@ -7,13 +6,16 @@ import matplotlib.pyplot as plt
 import matplotlib.font_manager as fm
 from datetime import datetime, timedelta, timezone
 from collections import Counter
+import io
 import os
+import sqlite3
+from gemini_clients import make_client_manager, make_keyed_model
+from solution_store import load_solution_blob
+from key_health import KEY_HEALTH_DB, classify_key_error, record_key_outcome
 
 st.set_page_config(page_title="Jutor 戰情監控室", page_icon="📊", layout="wide")
 
 tz_tw = timezone(timedelta(hours=8))
-current_time = datetime.now(tz_tw)
-current_time_str = current_time.strftime("%Y-%m-%d %H:%M:%S")
 
 def get_font_prop():
     font_file = "NotoSansTC-Regular.ttf"
@@ -23,8 +25,44 @@ def get_font_prop():
 
 font_prop = get_font_prop()
 
+# --- 圖表快取 ---
+# 圖表只依「數據版本」(統計結果) 決定，相同數據直接回傳快取的 PNG bytes，
+# 不會在每次 60 秒刷新或點按鈕時重新建立 figure；max_entries 限制快取大小。
+CHART_CACHE_ENTRIES = 8
+WALL_REFRESH_SECONDS = 60
+
+def fig_to_png_bytes(fig):
+    try:
+        buf = io.BytesIO()
+        fig.savefig(buf, format="png", bbox_inches="tight", dpi=100)
+        return buf.getvalue()
+    finally:
+        plt.close(fig)
+
+@st.cache_data(max_entries=CHART_CACHE_ENTRIES, show_spinner=False)
+def render_hour_chart(hour_counts):
+    fig1, ax1 = plt.subplots(figsize=(5, 3))
+    ax1.bar(range(24), hour_counts, color='skyblue')
+    ax1.set_xlabel('Hour (0-23)', fontproperties=font_prop)
+    ax1.set_ylabel('Count', fontproperties=font_prop)
+    ax1.set_xticks(range(0, 24, 2))
+    ax1.grid(axis='y', linestyle='--', alpha=0.5)
+    return fig_to_png_bytes(fig1)
+
+@st.cache_data(max_entries=CHART_CACHE_ENTRIES, show_spinner=False)
+def render_grade_chart(grade_items):
+    grades = [g for g, _ in grade_items]
+    sizes = [c for _, c in grade_items]
+    fig2, ax2 = plt.subplots(figsize=(5, 3))
+    wedges, texts, autotexts = ax2.pie(sizes, labels=grades, autopct='%1.1f%%', startangle=90)
+    if font_prop:
+        for text in texts: text.set_fontproperties(font_prop)
+        for autotext in autotexts: autotext.set_fontproperties(font_prop)
+    ax2.axis('equal')
+    return fig_to_png_bytes(fig2)
+
 st.title("📊 Jutor 戰情監控室")
-st.caption(f"目前台灣時間：{current_time_str}")
+wall_mode = st.toggle("🖥️ 牆面顯示模式 (每 60 秒自動刷新)", value=False)
 
 # --- 讀取數據 ---
 @st.cache_data(ttl=60)
@@ -44,102 +82,176 @@ def load_data_raw():
         st.error(f"無法讀取數據: {e}")
         return []
 
-data = load_data_raw()
+# --- 用量分析：牆面模式下只有這個 fragment 定時重跑，不會卡住其他按鈕 ---
+def render_analytics():
+    current_time = datetime.now(tz_tw)
+    st.caption(f"目前台灣時間：{current_time.strftime('%Y-%m-%d %H:%M:%S')}")
 
-st.markdown("### 📈 用量分析 (Analytics)")
+    data = load_data_raw()
 
-key_usage_counter = Counter()
+    st.markdown("### 📈 用量分析 (Analytics)")
 
-if data:
-    today_count = 0
-    grade_counter = Counter()
-    hour_counter = {i: 0 for i in range(24)}
+    if data:
+        today_count = 0
+        grade_counter = Counter()
+        hour_counter = {i: 0 for i in range(24)}
     
-    # 這裡的 today_str 是台灣時間的今天
-    today_str = current_time.strftime("%Y-%m-%d")
-    last_active_time = "無"
-
-    for row in data:
-        row_values = list(row.values())
-        if len(row_values) > 0:
-            possible_key = str(row_values[-1])
-            if len(possible_key) == 4:
-                key_usage_counter[possible_key] += 1
-        
-        keys_in_row = list(row.keys())
-        if len(keys_in_row) >= 2:
-            timestamp_str = str(row[keys_in_row[0]])
-            grade = str(row[keys_in_row[1]])
+        # 這裡的 today_str 是台灣時間的今天
+        today_str = current_time.strftime("%Y-%m-%d")
+        last_active_time = "無"
+
+        for row in data:
+            keys_in_row = list(row.keys())
+            if len(keys_in_row) >= 2:
+                timestamp_str = str(row[keys_in_row[0]])
+                grade = str(row[keys_in_row[1]])
             
-            try:
-                # 假設 Sheet 裡的資料是 UTC (因為 app.py 在 Cloud 上跑 datetime.now() 是 UTC)
-                # 所以我們讀出來後，要加 8 小時才是台灣時間
-                dt_utc = datetime.strptime(timestamp_str, "%Y-%m-%d %H:%M:%S")
-                dt_tw = dt_utc + timedelta(hours=8)
+                try:
+                    # 假設 Sheet 裡的資料是 UTC (因為 app.py 在 Cloud 上跑 datetime.now() 是 UTC)
+                    # 所以我們讀出來後，要加 8 小時才是台灣時間
+                    dt_utc = datetime.strptime(timestamp_str, "%Y-%m-%d %H:%M:%S")
+                    dt_tw = dt_utc + timedelta(hours=8)
                 
-                # 用台灣時間來判斷是不是「今天」
-                if dt_tw.strftime("%Y-%m-%d") == today_str:
-                    today_count += 1
-                    grade_counter[grade] += 1
-                    # 這裡統計的小時，就是台灣時間的小時了
-                    hour_counter[dt_tw.hour] += 1
-                    last_active_time = dt_tw.strftime("%H:%M")
-            except ValueError:
-                continue
-
-    daily_requests = today_count
-    estimated_tokens = daily_requests * 1200 
+                    # 用台灣時間來判斷是不是「今天」
+                    if dt_tw.strftime("%Y-%m-%d") == today_str:
+                        today_count += 1
+                        grade_counter[grade] += 1
+                        # 這裡統計的小時，就是台灣時間的小時了
+                        hour_counter[dt_tw.hour] += 1
+                        last_active_time = dt_tw.strftime("%H:%M")
+                except ValueError:
+                    continue
+
+        daily_requests = today_count
+        estimated_tokens = daily_requests * 1200 
     
-    if grade_counter:
-        top_grade = grade_counter.most_common(1)[0][0]
-    else:
-        top_grade = "無資料"
+        if grade_counter:
+            top_grade = grade_counter.most_common(1)[0][0]
+        else:
+            top_grade = "無資料"
 
-    col1, col2, col3, col4 = st.columns(4)
-    with col1: st.metric("今日解題數", f"{daily_requests} 題")
-    with col2: st.metric("今日估算 Token", f"{estimated_tokens:,}")
-    with col3: st.metric("今日熱門年級", top_grade)
-    with col4: st.metric("最後活躍時間", last_active_time)
+        col1, col2, col3, col4 = st.columns(4)
+        with col1: st.metric("今日解題數", f"{daily_requests} 題")
+        with col2: st.metric("今日估算 Token", f"{estimated_tokens:,}")
+        with col3: st.metric("今日熱門年級", top_grade)
+        with col4: st.metric("最後活躍時間", last_active_time)
 
-    col_chart1, col_chart2 = st.columns(2)
+        col_chart1, col_chart2 = st.columns(2)
     
-    with col_chart1:
-        st.markdown("#### 🕐 今日提問熱點 (台灣時間)")
-        if today_count > 0:
-            hours = list(hour_counter.keys())
-            counts = list(hour_counter.values())
-            fig1, ax1 = plt.subplots(figsize=(5, 3))
-            ax1.bar(hours, counts, color='skyblue')
-            ax1.set_xlabel('Hour (0-23)', fontproperties=font_prop)
-            ax1.set_ylabel('Count', fontproperties=font_prop)
-            ax1.set_xticks(range(0, 24, 2))
-            ax1.grid(axis='y', linestyle='--', alpha=0.5)
-            st.pyplot(fig1)
-        else:
-            st.info("今天還沒有人問問題喔")
-
-    with col_chart2:
-        st.markdown("#### 🏆 今日年級分佈")
-        if today_count > 0:
-            grades = list(grade_counter.keys())
-            sizes = list(grade_counter.values())
-            fig2, ax2 = plt.subplots(figsize=(5, 3))
-            wedges, texts, autotexts = ax2.pie(sizes, labels=grades, autopct='%1.1f%%', startangle=90)
-            if font_prop:
-                for text in texts: text.set_fontproperties(font_prop)
-                for autotext in autotexts: autotext.set_fontproperties(font_prop)
-            ax2.axis('equal')
-            st.pyplot(fig2)
-        else:
-            st.info("尚無年級數據")
+        with col_chart1:
+            st.markdown("#### 🕐 今日提問熱點 (台灣時間)")
+            if today_count > 0:
+                hour_counts = tuple(hour_counter[h] for h in range(24))
+                st.image(render_hour_chart(hour_counts), use_column_width=True)
+            else:
+                st.info("今天還沒有人問問題喔")
 
-else:
-    st.warning("⚠️ 目前讀取不到資料，請確認 Google Sheets 設定。")
+        with col_chart2:
+            st.markdown("#### 🏆 今日年級分佈")
+            if today_count > 0:
+                grade_items = tuple(sorted(grade_counter.items()))
+                st.image(render_grade_chart(grade_items), use_column_width=True)
+            else:
+                st.info("尚無年級數據")
+
+    else:
+        st.warning("⚠️ 目前讀取不到資料，請確認 Google Sheets 設定。")
+
+st.fragment(run_every=WALL_REFRESH_SECONDS if wall_mode else None)(render_analytics)()
+
+st.markdown("---")
+
+# --- 解答調閱：讀取 app.py 封存的壓縮解答 (Sheet 上的 blob:<id> 參照，見 solution_store.py) ---
+st.markdown("### 🗂️ 解答調閱 (Review)")
+review_ref = st.text_input("貼上 Sheet 中的解答參照", placeholder="blob:...")
+if review_ref:
+    stored = load_solution_blob(review_ref)
+    if stored:
+        with st.expander("📝 題目描述 (DESC)", expanded=False):
+            st.markdown(stored["image_desc"])
+        st.markdown(stored["full_response"].replace("===STEP===", "\n\n---\n\n"))
+        if stored.get("plot_code"):
+            with st.expander("📊 繪圖程式碼", expanded=False):
+                st.code(stored["plot_code"], language="python")
+    else:
+        st.warning("找不到這個解答參照，請確認是否與 app.py 在同一台主機。")
 
 st.markdown("---")
 
 st.markdown("### 🏥 API 健康診斷室 (Health Check)")
-st.caption("測試連線狀態，並統計歷史使用次數 (需配合 app.py v5.6 以上)。")
+st.caption("每把 key 的狀態來自 app.py 真實流量的被動紀錄；只有閒置太久的 key 才會主動探測。")
+
+# --- Key 健康紀錄 (app.py 的真實流量與這裡的探測都經由 key_health.record_key_outcome 寫入) ---
+KEY_IDLE_SECONDS = 30 * 60
+
+@st.cache_data(ttl=10)
+def load_key_health():
+    if not os.path.exists(KEY_HEALTH_DB):
+        return {}
+    try:
+        conn = sqlite3.connect(KEY_HEALTH_DB, timeout=5)
+        try:
+            conn.row_factory = sqlite3.Row
+            rows = conn.execute("SELECT * FROM key_health").fetchall()
+        finally:
+            conn.close()
+        return {row["key_suffix"]: dict(row) for row in rows}
+    except sqlite3.Error as e:
+        st.error(f"無法讀取 Key 健康紀錄: {e}")
+        return {}
+
+def summarize_key_health(stats, now_ts):
+    total = stats["success_count"] + stats["rate_limited_count"] + stats["unavailable_count"] + stats["invalid_count"] + stats["error_count"]
+    error_rate = (total - stats["success_count"]) / total if total else 0.0
+    avg_latency = stats["latency_total"] / stats["success_count"] if stats["success_count"] else None
+    cooldown_left = max(0, int(stats["cooldown_until"] - now_ts))
+    if stats["last_outcome"] == "invalid":
+        status, color = "❌ 無效", "grey"
+    elif stats["last_outcome"] == "success":
+        status, color = "✅ 正常", "green"
+    elif cooldown_left > 0:
+        status, color = f"🔴 冷卻中 ({cooldown_left}s)", "red"
+    else:
+        status, color = "⚠️ 錯誤", "orange"
+    last_seen = datetime.fromtimestamp(stats["last_seen"], tz_tw).strftime("%m-%d %H:%M:%S")
+    detail = f"錯誤率 {error_rate:.0%}"
+    if avg_latency is not None:
+        detail += f" · 平均 {avg_latency:.2f}s"
+    return status, color, detail, f"累計成功: {stats['success_count']} 次 · 最後: {last_seen}"
+
+# 每把 key 一個獨立的 client，不呼叫 process 共用的 genai.configure()
+@st.cache_resource
+def get_probe_model(key):
+    return make_keyed_model(make_client_manager(key), 'models/gemini-2.5-flash')
+
+# 探測結果也寫進同一份健康紀錄，之後的即時狀態與 app.py 看到的一致
+def probe_key(key):
+    try:
+        model = get_probe_model(key)
+        start_time = time.time()
+        model.generate_content("Hi", generation_config={"max_output_tokens": 1})
+        duration = time.time() - start_time
+        record_key_outcome(key[-4:], "success", duration)
+        return "✅ 正常", "green", f"探測 {duration:.2f}s"
+    except Exception as e:
+        outcome = classify_key_error(e)
+        record_key_outcome(key[-4:], outcome)
+        if outcome == "rate_limited":
+            return "🔴 額度滿", "red", "需冷卻"
+        elif outcome == "invalid":
+            return "❌ 無效", "grey", "Key Error"
+        else:
+            return "⚠️ 錯誤", "orange", "Unknown"
+
+def show_key_row(masked_key, status, color, detail, usage_text):
+    c1, c2, c3, c4 = st.columns([2, 2, 2, 2])
+    with c1: st.code(masked_key)
+    with c2:
+        if color == "green": st.success(status)
+        elif color == "red": st.error(status)
+        else: st.warning(status)
+    with c3: st.caption(detail)
+    with c4: st.info(usage_text)
 
 use_secrets = st.checkbox("直接讀取 Secrets 裡的鑰匙", value=True)
 api_keys = []
@@ -156,55 +268,35 @@ else:
         raw_keys = user_input.replace("\n", ",").split(",")
         api_keys = [k.strip() for k in raw_keys if k.strip()]
 
-if st.button("🚀 啟動全系統掃描", type="primary"):
-    diagnosis_time = datetime.now(tz_tw).strftime("%Y-%m-%d %H:%M:%S")
-    
-    if not api_keys:
-        st.error("沒有鑰匙可以測試！")
+key_health = load_key_health()
+now_ts = time.time()
+idle_keys = [k for k in api_keys if k[-4:] not in key_health or now_ts - key_health[k[-4:]]["last_seen"] > KEY_IDLE_SECONDS]
+
+st.markdown("#### 📡 即時狀態 (來自真實流量)")
+if not api_keys:
+    st.info("沒有鑰匙可以顯示。")
+for key in api_keys:
+    stats = key_health.get(key[-4:])
+    if stats and key not in idle_keys:
+        show_key_row(f"...{key[-4:]}", *summarize_key_health(stats, now_ts))
+    elif stats:
+        status, color, detail, usage_text = summarize_key_health(stats, now_ts)
+        show_key_row(f"...{key[-4:]}", "💤 閒置", "orange", detail, usage_text)
     else:
-        st.markdown(f"**掃描時間：** `{diagnosis_time}`")
-        progress_bar = st.progress(0)
-        target_keys = api_keys.copy()
-        
-        for i, key in enumerate(target_keys):
-            masked_key = f"...{key[-4:]}"
-            usage_count = key_usage_counter.get(key[-4:], 0)
-            
-            try:
-                genai.configure(api_key=key)
-                model = genai.GenerativeModel('models/gemini-2.5-flash')
-                start_time = time.time()
-                response = model.generate_content("Hi", generation_config={"max_output_tokens": 1})
-                duration = time.time() - start_time
-                status = "✅ 正常"
-                detail = f"{duration:.2f}s"
-                color = "green"
-            except Exception as e:
-                error_msg = str(e)
-                if "429" in error_msg or "Quota exceeded" in error_msg:
-                    status = "🔴 額度滿"
-                    detail = "需冷卻"
-                    color = "red"
-                elif "API key not valid" in error_msg:
-                    status = "❌ 無效"
-                    detail = "Key Error"
-                    color = "grey"
-                else:
-                    status = "⚠️ 錯誤"
-                    detail = "Unknown"
-                    color = "orange"
-            
-            progress_bar.progress((i + 1) / len(target_keys))
-            
-            c1, c2, c3, c4 = st.columns([2, 2, 2, 2])
-            with c1: st.code(masked_key)
-            with c2: 
-                if color == "green": st.success(status)
-                elif color == "red": st.error(status)
-                else: st.warning(status)
-            with c3: st.caption(detail)
-            with c4: st.info(f"累計使用: {usage_count} 次")
-            
-            time.sleep(0.2)
-            
-        st.success("掃描完成！")
+        show_key_row(f"...{key[-4:]}", "💤 尚無紀錄", "orange", "-", "累計成功: 0 次")
+
+if st.button(f"🚀 探測閒置的鑰匙 ({len(idle_keys)} 把)", type="primary", disabled=not idle_keys):
+    diagnosis_time = datetime.now(tz_tw).strftime("%Y-%m-%d %H:%M:%S")
+    st.markdown(f"**掃描時間：** `{diagnosis_time}`")
+    progress_bar = st.progress(0)
+
+    for i, key in enumerate(idle_keys):
+        status, color, detail = probe_key(key)
+        stats = key_health.get(key[-4:])
+        usage_text = f"累計成功: {stats['success_count'] if stats else 0} 次"
+        progress_bar.progress((i + 1) / len(idle_keys))
+        show_key_row(f"...{key[-4:]}", status, color, detail, usage_text)
+        time.sleep(0.2)
+
+    load_key_health.clear()
+    st.success("掃描完成！")
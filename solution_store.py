@@ -0,0 +1,81 @@
+import gzip
+import hashlib
+import json
+import os
+import re
+import threading
+
+# --- 解答封存區 (壓縮、內容定址) ---
+# 完整解答、DESC、繪圖程式碼壓縮後存在本機，檔名就是內容的 sha256，
+# 相同解答只會存一份；Sheet 只記錄 "blob:<id>" 參照與摘要。
+# app.py 負責寫入、monitor.py 負責調閱，兩邊都從這裡取路徑與讀寫函式。
+BLOB_DIR = "jutor_blobs"
+BLOB_REF_PREFIX = "blob:"
+
+def write_gzip_once(path, payload):
+    if os.path.exists(path):
+        return
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with gzip.open(tmp_path, "wb", compresslevel=9) as f:
+        f.write(payload)
+    os.replace(tmp_path, path)
+
+def store_solution_blob(full_response, image_desc="", plot_code=None):
+    payload = json.dumps(
+        {"full_response": full_response, "image_desc": image_desc, "plot_code": plot_code},
+        ensure_ascii=False, sort_keys=True,
+    ).encode("utf-8")
+    blob_id = hashlib.sha256(payload).hexdigest()
+    write_gzip_once(os.path.join(BLOB_DIR, f"{blob_id}.json.gz"), payload)
+    return BLOB_REF_PREFIX + blob_id
+
+def load_solution_blob(ref):
+    ref = str(ref or "").strip()
+    if not ref.startswith(BLOB_REF_PREFIX):
+        return None
+    blob_id = ref[len(BLOB_REF_PREFIX):]
+    if not re.fullmatch(r"[0-9a-f]{64}", blob_id):
+        return None
+    try:
+        with gzip.open(os.path.join(BLOB_DIR, f"{blob_id}.json.gz"), "rb") as f:
+            return json.loads(f.read().decode("utf-8"))
+    except (OSError, ValueError):
+        return None
+
+# --- 分享解答 (?sid= 永久連結) ---
+# 分享紀錄只存年級、模式與指向解答封存的參照，步驟 / DESC / 圖形內容不重複存一份；
+# 短 ID 取自紀錄內容的雜湊，同一份解答重複分享只會得到同一個 sid。
+SOLUTION_DIR = "jutor_solutions"
+SOLUTION_ID_LENGTH = 10
+
+def store_solution_record(grade, mode, blob_ref, use_pro=False):
+    payload = json.dumps(
+        {"grade": grade, "mode": mode, "blob_ref": blob_ref, "use_pro": use_pro},
+        ensure_ascii=False, sort_keys=True,
+    ).encode("utf-8")
+    sid = hashlib.sha256(payload).hexdigest()[:SOLUTION_ID_LENGTH]
+    write_gzip_once(os.path.join(SOLUTION_DIR, f"{sid}.json.gz"), payload)
+    return sid
+
+def load_solution_record(sid):
+    if not sid or not re.fullmatch(rf"[0-9a-f]{{{SOLUTION_ID_LENGTH}}}", str(sid)):
+        return None
+    try:
+        with gzip.open(os.path.join(SOLUTION_DIR, f"{sid}.json.gz"), "rb") as f:
+            record = json.loads(f.read().decode("utf-8"))
+    except (OSError, ValueError):
+        return None
+    stored = load_solution_blob(record.get("blob_ref"))
+    if not stored:
+        return None
+    steps = [step.strip() for step in stored["full_response"].split("===STEP===") if step.strip()]
+    return {
+        "grade": record["grade"],
+        "mode": record["mode"],
+        "use_pro": record["use_pro"],
+        "blob_ref": record["blob_ref"],
+        "steps": steps,
+        "image_desc": stored["image_desc"],
+        "plot_code": stored["plot_code"],
+    }